@@ -1,14 +1,35 @@
+from __future__ import annotations
+
 import os
-from typing import Dict, List, Tuple, Literal, TypedDict
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from queue import Queue
+from types import MappingProxyType
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Collection,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Mapping,
+    Optional,
+    Tuple,
+    TypedDict,
+)
 from unicodedata import normalize, east_asian_width
 
-import deepl
-import googletrans
-from langdetect import detect
-import nltk
-from nltk.tokenize import word_tokenize, sent_tokenize
 from termcolor import COLORS, colored
 
+# The translators and nltk are slow to import, so they are imported where used
+if TYPE_CHECKING:
+    import deepl
+    import googletrans
+    from nltk.tag import PerceptronTagger
+
 
 Tag = str
 Token = str
@@ -16,86 +37,141 @@ Token = str
 
 class TaggedTokens(TypedDict):
     text: str
-    token_tag_pairs: List[Tuple[Token, Tag]]
+    tokens: List[Token]
+    tags: List[Tag]
+
+
+# Penn Treebank tags mapped to their abbreviation, expansion and Japanese name
+TAG_TABLE: Mapping[Tag, Tuple[str, str, str]] = MappingProxyType(
+    {
+        "CC": ("CC", "Coordinating conjunction", "調整接続詞"),
+        "CD": ("CD", "Cardinal number", "基数"),
+        "DT": ("DT", "Determiner", "限定詞"),
+        "EX": ("EX", "Existential there", "存在を表す there"),
+        "FW": ("FW", "Foreign word", "外国語"),
+        "IN": ("IN", "Preposition or subordinating conjunction", "前置詞|従属接続詞"),
+        "JJ": ("JJ", "Adjective", "形容詞"),
+        "JJR": ("JJR", "Adjective, comparative", "形容詞(比較級)"),
+        "JJS": ("JJS", "Adjective, superlative", "形容詞(最上級)"),
+        "LS": ("LS", "List item marker", "-"),
+        "MD": ("MD", "Modal", "法"),
+        "NN": ("NN", "Noun, singular or mass", "名詞"),
+        "NNS": ("NNS", "Noun, plural", "名詞(複数形)"),
+        "NNP": ("NNP", "Proper noun, singular", "固有名詞"),
+        "NNPS": ("NNPS", "Proper noun, plural", "固有名詞(複数形)"),
+        "PDT": ("PDT", "Predeterminer", "前限定辞"),
+        "POS": ("POS", "Possessive ending", "所有格の終わり"),
+        "PRP": ("PRP", "Personal pronoun", "人称代名詞"),
+        "PRP$": ("PRP$", "Possessive pronoun", "所有代名詞"),
+        "RB": ("RB", "Adverb", "副詞"),
+        "RBR": ("RBR", "Adverb, comparative", "副詞(比較級)"),
+        "RBS": ("RBS", "Adverb, superlative", "副詞(最上級)"),
+        "RP": ("RP", "Particle", "不変化詞"),
+        "SYM": ("SYM", "Symbol", "記号"),
+        "TO": ("TO", "to", "前置詞 to"),
+        "UH": ("UH", "Interjection", "感嘆詞"),
+        "VB": ("VB", "Verb, base form", "動詞(原形)"),
+        "VBD": ("VBD", "Verb, past tense", "動詞(過去形)"),
+        "VBG": ("VBG", "Verb, gerund or present participle", "動詞(動名詞|現在分詞)"),
+        "VBN": ("VBN", "Verb, past participle", "動詞(過去分詞)"),
+        "VBP": (
+            "VBP",
+            "Verb, non-3rd person singular present",
+            "動詞(三人称単数以外の現在形)",
+        ),
+        "VBZ": ("VBZ", "Verb, 3rd person singular present", "動詞(三人称単数の現在形)"),
+        "WDT": ("WDT", "Wh-determiner", "Wh 限定詞"),
+        "WP": ("WP", "Wh-pronoun", "Wh 代名詞"),
+        "WP$": ("WP$", "Possessive wh-pronoun", "所有 Wh 代名詞"),
+        "WRB": ("WRB", "Wh-adverb", "Wh 副詞"),
+        ",": (",", ",", ","),
+        ".": (".", ".", "."),
+    }
+)
 
 
 class MorphologicalAnalyzer:
-    tag_table = {
-        "CC": ["Coordinating conjunction", "調整接続詞"],
-        "CD": ["Cardinal number", "基数"],
-        "DT": ["Determiner", "限定詞"],
-        "EX": ["Existential there", "存在を表す there"],
-        "FW": ["Foreign word", "外国語"],
-        "IN": ["Preposition or subordinating conjunction", "前置詞|従属接続詞"],
-        "JJ": ["Adjective", "形容詞"],
-        "JJR": ["Adjective, comparative", "形容詞(比較級)"],
-        "JJS": ["Adjective, superlative", "形容詞(最上級)"],
-        "LS": ["List item marker", "-"],
-        "MD": ["Modal", "法"],
-        "NN": ["Noun, singular or mass", "名詞"],
-        "NNS": ["Noun, plural", "名詞(複数形)"],
-        "NNP": ["Proper noun, singular", "固有名詞"],
-        "NNPS": ["Proper noun, plural", "固有名詞(複数形)"],
-        "PDT": ["Predeterminer", "前限定辞"],
-        "POS": ["Possessive ending", "所有格の終わり"],
-        "PRP": ["Personal pronoun", "人称代名詞"],
-        "PRP$": ["Possessive pronoun", "所有代名詞"],
-        "RB": ["Adverb", "副詞"],
-        "RBR": ["Adverb, comparative", "副詞(比較級)"],
-        "RBS": ["Adverb, superlative", "副詞(最上級)"],
-        "RP": ["Particle", "不変化詞"],
-        "SYM": ["Symbol", "記号"],
-        "TO": ["to", "前置詞 to"],
-        "UH": ["Interjection", "感嘆詞"],
-        "VB": ["Verb, base form", "動詞(原形)"],
-        "VBD": ["Verb, past tense", "動詞(過去形)"],
-        "VBG": ["Verb, gerund or present participle", "動詞(動名詞|現在分詞)"],
-        "VBN": ["Verb, past participle", "動詞(過去分詞)"],
-        "VBP": ["Verb, non-3rd person singular present", "動詞(三人称単数以外の現在形)"],
-        "VBZ": ["Verb, 3rd person singular present", "動詞(三人称単数の現在形)"],
-        "WDT": ["Wh-determiner", "Wh 限定詞"],
-        "WP": ["Wh-pronoun", "Wh 代名詞"],
-        "WP$": ["Possessive wh-pronoun", "所有 Wh 代名詞"],
-        "WRB": ["Wh-adverb", "Wh 副詞"],
-        ",": [",", ","],
-        ".": [".", "."],
-    }
+    tag_table = TAG_TABLE
 
     def __init__(
         self, tag_type: Literal["abbreviation", "expansion", "japanese"] = None
     ) -> None:
         self.tag_type = "abbreviation" if tag_type is None else tag_type
 
+        # Select the tag names to display once instead of per token
+        index = {"expansion": 1, "japanese": 2}.get(self.tag_type)
+        self._tag_map = None
+        if index is not None:
+            self._tag_map = {tag: names[index] for tag, names in self.tag_table.items()}
+        self._tagger = None
+
+    @property
+    def tagger(self) -> PerceptronTagger:
+        # Loading the tagger model is expensive, so it is done once on first use
+        if self._tagger is None:
+            from nltk.tag import PerceptronTagger
+
+            self._tagger = PerceptronTagger()
+        return self._tagger
+
     def analyze(self, texts: str) -> List[TaggedTokens]:
-        texts: List[str] = sent_tokenize(texts)
+        from nltk.tokenize import sent_tokenize
 
-        result = []
-        for text in texts:
-            tokens = self.tokenize(text)
-            tagged_tokens = nltk.pos_tag(tokens)
+        texts: List[str] = sent_tokenize(texts)
 
-            if self.tag_type == "abbreviation":
-                result.append(TaggedTokens(text=text, token_tag_pairs=tagged_tokens))
-                continue
+        # The texts are already split into sentences, so skip word_tokenize's own pass
+        token_lists = [self.tokenize(text, preserve_line=True) for text in texts]
+        tagged_token_lists = self.tagger.tag_sents(token_lists)
 
-            index = 0 if self.tag_type == "expansion" else 1
-            expression = lambda item: (item[0], self.tag_table[item[1]][index])
-            tagged_tokens = list(map(expression, tagged_tokens))
-            result.append(TaggedTokens(text=text, token_tag_pairs=tagged_tokens))
+        tag_map = self._tag_map
+        result = []
+        for text, tokens, tagged_tokens in zip(texts, token_lists, tagged_token_lists):
+            tags = [tag for _, tag in tagged_tokens]
+            if tag_map is not None:
+                tags = [tag_map[tag] for tag in tags]
+            result.append(TaggedTokens(text=text, tokens=tokens, tags=tags))
 
         return result
 
     @staticmethod
     def setup() -> None:
+        import nltk
+
         nltk.download("punkt")
         nltk.download("averaged_perceptron_tagger")
 
     @staticmethod
-    def tokenize(text: str) -> List[str]:
-        return word_tokenize(text)
+    def tokenize(text: str, preserve_line: bool = False) -> List[str]:
+        from nltk.tokenize import word_tokenize
+
+        return word_tokenize(text, preserve_line=preserve_line)
+
+
+# Table for `str.translate` that replaces each wide character with two spaces
+class WideCharacterTable(dict):
+    def __missing__(self, codepoint: int) -> str:
+        character = chr(codepoint)
+        if east_asian_width(character) != "W":
+            self[codepoint] = character
+            return character
+        self[codepoint] = "  "
+        return "  "
+
+
+# Seeded with the characters of the tag names, others are added on first use
+WIDE_CHARACTER_TABLE = WideCharacterTable(
+    (ord(character), "  ")
+    for names in TAG_TABLE.values()
+    for name in names
+    for character in normalize("NFKC", name)
+    if east_asian_width(character) == "W"
+)
 
 
 class TextsFormatter:
+    cache_size = 4096
+    max_workers = 8
+
     def __init__(
         self,
         is_list: bool = False,
@@ -109,94 +185,195 @@ class TextsFormatter:
         self.color_enabled = color_enabled
         self.language_code = language_code
         self.colors_to_remove = colors_to_remove
+        self._translators = threading.local()
+        self._pool = None
+        self._translation_cache: OrderedDict[Tuple[str, str], str] = OrderedDict()
 
     def format_token_tag_pairs(
         self, token_tag_pairs: List[Tuple[Token, Tag]]
     ) -> List[str]:
-        # Create an object where tag is key and color is value
-        tags = list(set([tag for _, tag in token_tag_pairs]))
-        color_tag = self.generate_color_tag(tags, self.colors_to_remove)
-
-        tag_list = set()
-        tokens, under_line, part_of_speech_line = "", "", ""
-
-        color = ""
-        for token, tag in token_tag_pairs:
-            tag_length = self.adjust_length_ja_en(tag)
-            if self.color_enabled:
-                color = color_tag[tag]
-                tag = colored(tag, color)
+        tokens = [token for token, _ in token_tag_pairs]
+        tags = [tag for _, tag in token_tag_pairs]
+        return self.format_tokens(tokens, tags)
 
+    def format_tokens(self, tokens: List[Token], tags: List[Tag]) -> List[str]:
+        # Create an object where tag is key and color is value
+        unique_tags = list(dict.fromkeys(tags))
+        colors_to_remove = set(self.colors_to_remove)
+        color_tag = self.generate_color_tag(unique_tags, colors_to_remove)
+
+        # Prepare everything per token up front as lists parallel to `tokens`
+        column_widths, tag_widths = self.measure_columns(tokens, tags)
+        paddings = [
+            (column_width - tag_width) * " "
+            for column_width, tag_width in zip(column_widths, tag_widths)
+        ]
+        colors, display_tags = [""] * len(tags), tags
+        if self.color_enabled:
+            colored_tags = {
+                tag: colored(tag, color) for tag, color in color_tag.items()
+            }
+            colors = [color_tag[tag] for tag in tags]
+            display_tags = [colored_tags[tag] for tag in tags]
+
+        colored_under_lines = {}
+        token_parts, under_line_parts, part_of_speech_parts = [], [], []
+        for token, tag, padding, color, column_width in zip(
+            tokens, display_tags, paddings, colors, column_widths
+        ):
             # Tag and part of speech
-            adjusted_length = len(token)
-            if not self.is_list:
-                adjusted_length = max(adjusted_length, tag_length)
-                if tag_length < adjusted_length:
-                    tag += abs(tag_length - adjusted_length) * " "
-            else:
-                tag_list.add(tag)
-            tokens += f" {token.ljust(adjusted_length, ' ')}"
-            part_of_speech_line += f" {tag}"
+            token_parts.append(token.ljust(column_width, " "))
+            part_of_speech_parts.append(tag + padding)
 
             # Token under line
-            token_under_line = adjusted_length * "▔"
             if self.color_enabled:
-                token_under_line = colored(token_under_line, color)
-            under_line += f" {token_under_line}"
+                key = (color, column_width)
+                if key not in colored_under_lines:
+                    colored_under_lines[key] = colored(column_width * "▔", color)
+                token_under_line = colored_under_lines[key]
+            else:
+                token_under_line = column_width * "▔"
+            under_line_parts.append(token_under_line)
 
+        # Every part is preceded by a space
+        token_line = "".join(f" {part}" for part in token_parts)
+        under_line = "".join(f" {part}" for part in under_line_parts)
+        part_of_speech_line = "".join(f" {part}" for part in part_of_speech_parts)
         if self.is_list:
-            tag_list = [f"- {tag}" for tag in sorted(tag_list, key=len)]
+            unique_display_tags = dict.fromkeys(display_tags)
+            tag_list = [f"- {tag}" for tag in sorted(unique_display_tags, key=len)]
             part_of_speech_line = "\n".join(tag_list)
 
-        return [tokens, under_line, part_of_speech_line]
+        return [token_line, under_line, part_of_speech_line]
+
+    def measure_columns(
+        self, tokens: List[Token], tags: List[Tag]
+    ) -> Tuple[List[int], List[int]]:
+        # Terminal columns taken by each token and by its tag, without color handling
+        column_widths = [len(token) for token in tokens]
+        if self.is_list:
+            # Tags are listed separately, so they are never padded to the token
+            return column_widths, column_widths
+
+        tag_widths = [self.adjust_length_ja_en(tag) for tag in tags]
+        column_widths = [
+            max(column_width, tag_width)
+            for column_width, tag_width in zip(column_widths, tag_widths)
+        ]
+        return column_widths, tag_widths
 
     def format(self, texts_data: List[TaggedTokens]) -> str:
-        formatted_texts = []
-        for text_data in texts_data:
-            token_tag_pairs = text_data.get("token_tag_pairs")
-            text = text_data.get("text")
+        return "\n".join(self.format_iter(texts_data))
+
+    def format_iter(self, texts_data: List[TaggedTokens]) -> Iterator[str]:
+        texts = [text_data.get("text") for text_data in texts_data]
+        if self.is_translate:
+            translated_texts = self.translate_batch(texts)
+        else:
+            translated_texts = [None] * len(texts)
+
+        terminal_width = os.get_terminal_size().columns
+        separator = f"\n{terminal_width * '─'}\n"
+
+        for text_data, translated_text in zip(texts_data, translated_texts):
+            tokens = text_data.get("tokens")
+            tags = text_data.get("tags")
 
-            formatted_text = self.format_token_tag_pairs(token_tag_pairs)
+            formatted_text = self.format_tokens(tokens, tags)
             if self.is_translate:
-                translated_text = self.translate(text)
                 formatted_text.append(f"\n{translated_text}")
 
-            terminal_width = os.get_terminal_size().columns
-            formatted_text.append(f"\n{terminal_width * '─'}\n")
-            formatted_texts.append("\n".join(formatted_text))
+            formatted_text.append(separator)
+            yield "\n".join(formatted_text)
 
-        return "\n".join(formatted_texts)
+    @property
+    def translator(self) -> googletrans.Translator:
+        # Reuse a client so its HTTP connections are kept alive across calls. Each
+        # thread gets its own, as httpcore 0.9 does not lock its HTTP/2 streams.
+        translator = getattr(self._translators, "translator", None)
+        if translator is None:
+            translator = self.create_translator()
+            self._translators.translator = translator
+        return translator
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._pool
+
+    def create_translator(self) -> googletrans.Translator:
+        import googletrans
+
+        return googletrans.Translator()
 
     def translate(self, text: str) -> str:
-        translator = googletrans.Translator()
-        if self.language_code is None:
-            return text
-        translated_text = translator.translate(text=text, dest=self.language_code).text
-        return translated_text
+        return self.translate_batch([text])[0]
+
+    def translate_batch(self, texts: List[str]) -> List[str]:
+        if self.language_code is None or not texts:
+            return texts
+
+        # Look up previous translations first, least recently used ones are evicted
+        cache = self._translation_cache
+        translated_texts = [None] * len(texts)
+        untranslated_indexes = []
+        for index, text in enumerate(texts):
+            key = (text, self.language_code)
+            if key in cache:
+                cache.move_to_end(key)
+                translated_texts[index] = cache[key]
+            else:
+                untranslated_indexes.append(index)
 
-    @staticmethod
-    def adjust_length_ja_en(ja_string: str) -> int:
-        ja_characters = list(normalize("NFKC", ja_string))
+        if not untranslated_indexes:
+            return translated_texts
 
-        adjusted_length = 0
-        for character in ja_characters:
-            if east_asian_width(character) == "W":
-                adjusted_length += 2
-                continue
-            adjusted_length += 1
+        # Request each distinct text once, even if it appears several times
+        untranslated_texts = list(
+            dict.fromkeys(texts[index] for index in untranslated_indexes)
+        )
+        results = dict(
+            zip(untranslated_texts, self.translate_texts(untranslated_texts))
+        )
+        for index in untranslated_indexes:
+            translated_texts[index] = results[texts[index]]
+
+        for text, translated_text in results.items():
+            cache[(text, self.language_code)] = translated_text
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+
+        return translated_texts
+
+    def translate_texts(self, texts: List[str]) -> List[str]:
+        # googletrans has no batch API, so the texts are translated concurrently
+        translate = lambda text: self.translator.translate(
+            text=text, dest=self.language_code
+        ).text
+        return list(self.pool.map(translate, texts))
 
-        return int(adjusted_length)
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def adjust_length_ja_en(ja_string: str) -> int:
+        ja_string = normalize("NFKC", ja_string)
+        if ja_string.isascii():
+            return len(ja_string)
+        return len(ja_string.translate(WIDE_CHARACTER_TABLE))
 
     @staticmethod
     def generate_color_tag(
-        tags: List[str], colors_to_remove: List[str] = []
-    ) -> Dict[str, str]:
-        colors = [color for color in COLORS.keys() if color not in colors_to_remove]
-        result = {tag: color for tag, color in zip(tags, colors)}
+        tags: List[str], colors_to_remove: Collection[str] = []
+    ) -> Dict[str, Optional[str]]:
+        colors = (color for color in COLORS if color not in colors_to_remove)
+        # Tags left over once the colors run out are printed without color
+        result = {tag: next(colors, None) for tag in tags}
         return result
 
 
 class TextsFormatterDeepL(TextsFormatter):
+    max_request_texts = 50
+
     def __init__(
         self,
         api_key: str,
@@ -211,16 +388,23 @@ class TextsFormatterDeepL(TextsFormatter):
         )
         self.api_key = api_key
 
-    def translate(self, text: str) -> str:
-        translator = deepl.Translator(self.api_key).translate_text
-        if self.language_code is None:
-            return text
+    def create_translator(self) -> deepl.Translator:
+        import deepl
 
-        source_lang = detect(text)
-        translated_text = translator(
-            text=text, source_lang=source_lang, target_lang=self.language_code
-        )
-        return str(translated_text)
+        return deepl.Translator(self.api_key)
+
+    def translate_texts(self, texts: List[str]) -> List[str]:
+        # DeepL accepts a limited number of texts per request
+        translated_texts = []
+        for start in range(0, len(texts), self.max_request_texts):
+            # DeepL detects the source language of each text on the server side
+            results = self.translator.translate_text(
+                text=texts[start : start + self.max_request_texts],
+                source_lang=None,
+                target_lang=self.language_code,
+            )
+            translated_texts.extend(str(result) for result in results)
+        return translated_texts
 
 
 class InteractiveMode:
@@ -232,6 +416,11 @@ class InteractiveMode:
         self.running = False
         self.texts_formatter = texts_formatter
         self.morphological_analyzer = morphological_analyzer
+        # Commands run on the printer thread so they stay in order with the output
+        self.commands: Dict[str, Callable[[], None]] = {
+            "c": self.clear,
+            "help": self.help,
+        }
 
     def start(self) -> None:
         self.running = True
@@ -250,30 +439,75 @@ class InteractiveMode:
         self.clear()
         self.start()
 
+        # Analyze and print on separate threads so that input is not blocked
+        commands: Queue = Queue()
+        outputs: Queue = Queue()
+        workers = [
+            threading.Thread(
+                target=self.analyze_commands, args=(commands, outputs), daemon=True
+            ),
+            threading.Thread(target=self.print_outputs, args=(outputs,), daemon=True),
+        ]
+        for worker in workers:
+            worker.start()
+
+        # The printer thread draws the prompt so that it always follows the output
+        outputs.put(self.prompt)
         while self.running:
             try:
-                command = input("> ")
+                command = input()
             except KeyboardInterrupt:
                 break
 
-            match command:
-                case "q":
-                    break
-                case "c":
-                    self.clear()
-                    continue
-                case "help":
-                    self.help()
-                    continue
-                case _:
-                    pass
-
-            analyzed_texts = self.morphological_analyzer.analyze(command)
-            formatted_texts = self.texts_formatter.format(analyzed_texts)
-            print(formatted_texts)
+            if command == "q":
+                break
+
+            commands.put(command)
+
+        # Finish the texts that are still queued before terminating
+        self.running = False
+        commands.put(None)
+        for worker in workers:
+            worker.join()
 
         self.stop()
 
+    def analyze_commands(self, commands: Queue, outputs: Queue) -> None:
+        while (command := commands.get()) is not None:
+            action = self.commands.get(command)
+            if action is not None:
+                outputs.put(action)
+                if commands.empty():
+                    outputs.put(self.prompt)
+                continue
+
+            # Report a failing input and keep accepting the next ones
+            try:
+                analyzed_texts = self.morphological_analyzer.analyze(command)
+                # Print each sentence as soon as it is formatted
+                for formatted_text in self.texts_formatter.format_iter(analyzed_texts):
+                    outputs.put(formatted_text)
+            except Exception as error:
+                outputs.put(f"Failed to process the input: {error!r}")
+            finally:
+                # Lines typed ahead are printed first, then the prompt is redrawn
+                if self.running and commands.empty():
+                    outputs.put(self.prompt)
+
+        outputs.put(None)
+
+    @staticmethod
+    def prompt() -> None:
+        print("> ", end="", flush=True)
+
+    @staticmethod
+    def print_outputs(outputs: Queue) -> None:
+        while (output := outputs.get()) is not None:
+            if callable(output):
+                output()
+                continue
+            print(output)
+
     @staticmethod
     def clear() -> None:
         # Windows